@@ -1,4 +1,5 @@
 import pandas as pd
+import polars as pl
 import time
 import argparse
 import os
@@ -11,6 +12,7 @@ from app.utils import (
     get_latest_datetime,
     get_activities,
     get_column_names,
+    ingest_dataframe,
 )
 
 
@@ -68,34 +70,42 @@ def main(mode):
 
     if not activities:
         return
-    df = pd.DataFrame(activities)
+    df = pl.from_dicts(activities, infer_schema_length=None)
 
-    df[["map_id", "summary_polyline", "map_resource_state"]] = df["map"].apply(
-        pd.Series
-    )
-    df = df.rename(columns={"type": "activities_type", "id": "activity_id"})
-    df = df.drop(["map"], axis=1)
-
-    # NOTE for some reason, the .to_sql only works when saving and reloading the csv.
-    # Save and load csv
-    df.to_csv("activities.csv", index=False)
-    df = pd.read_csv(
-        "activities.csv",
-        index_col="activity_id",
-    )
+    # Flatten the nested "map" struct
+    df = df.with_columns(
+        pl.col("map").struct.field("id").alias("map_id"),
+        pl.col("map").struct.field("summary_polyline"),
+        pl.col("map").struct.field("resource_state").alias("map_resource_state"),
+    ).drop("map")
+    df = df.rename({"type": "activities_type", "id": "activity_id"})
 
     # Assure correct database schema
     columns = get_column_names(engine, "activities")
-    df = df[[c for c in df.columns if c in columns]]
+    df = df.select([c for c in df.columns if c in columns])
+
+    # Fix dtypes. Nested values (athlete struct, latlng lists) are stored as text
+    df = df.with_columns(
+        pl.col("athlete").struct.json_encode(),
+        *[
+            pl.format(
+                "[{}]",
+                pl.col(col).list.eval(pl.element().cast(pl.String)).list.join(", "),
+            ).alias(col)
+            for col in ["start_latlng", "end_latlng"]
+        ],
+        pl.col("start_date").str.to_datetime(time_zone="UTC"),
+        pl.col("start_date_local").str.to_datetime().dt.replace_time_zone(None),
+        pl.col("distance", "total_elevation_gain").cast(pl.Float64),
+        pl.col("moving_time", "elapsed_time").cast(pl.Int64),
+    )
+
+    # Hand the Arrow buffers to pandas without copying for the database load
+    df = df.to_pandas(use_pyarrow_extension_array=True).set_index("activity_id")
 
     # Move date to postgres database
     try:
-        df.to_sql(
-            "activities",
-            con=engine,
-            if_exists="append",
-            index=True,
-        )
+        ingest_dataframe(df, "activities", engine)
     except ValueError as e:
         print(e)
 
@@ -1,13 +1,23 @@
 import webbrowser
 import requests
-import json
+import asyncio
+import aiohttp
+import orjson
+import csv
+import io
+import itertools
 import os
 import logging
 import time
-import pytz
+import psycopg2
+import pyarrow as pa
+import adbc_driver_postgresql.dbapi as pg_dbapi
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlalchemy import create_engine, text, inspect
+from sqlalchemy import BigInteger, Integer, Float, Boolean, DateTime
 from sqlalchemy.exc import ProgrammingError
 
 # Set up logging
@@ -17,6 +27,36 @@ logger = logging.getLogger(__name__)
 # Base url
 BASE_URL = "https://www.strava.com/api/v3/"
 
+# Activities per page; a full first page means more pages may follow
+PER_PAGE = 30
+
+# Number of activity pages requested concurrently once page 1 comes back full
+PAGE_WINDOW = 8
+
+# Rows per batch when copying data into postgres
+INGEST_BATCH_SIZE = 10_000
+
+# Retries on rate limits and server errors (sync and async requests)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+
+# Pooled HTTP session (keep-alive, retries on rate limits and server errors)
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+        ),
+    ),
+)
+
 
 def get_tokens(refresh_token=None):
 
@@ -52,7 +92,7 @@ def get_tokens(refresh_token=None):
 
     response = requests.post("https://www.strava.com/api/v3/oauth/token", data=payload)
     if response.status_code == 200:
-        response_dict = response.json()
+        response_dict = orjson.loads(response.content)
 
         return (
             response_dict["access_token"],
@@ -82,7 +122,6 @@ def get_strava_authorization_url(
 
 
 def get_column_names(engine, table):
-    engine = get_engine()
     inspector = inspect(engine)
     return [col["name"] for col in inspector.get_columns(table)]
 
@@ -94,21 +133,64 @@ def get_athlete_info(access_token):
     return athlete
 
 
+async def _fetch_page(session, url):
+    """Request one page, retrying rate limits and server errors with backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        async with session.get(url) as response:
+            if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                # Raise instead of returning None, which would read as the last page
+                response.raise_for_status()
+                return await response.json(loads=orjson.loads)
+            retry_after = response.headers.get("Retry-After", "")
+            logger.warning(f"HTTP error {response.status}: {response.reason}")
+
+        delay = (
+            float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+        )
+        logger.info(f"Retrying in {delay} seconds ...")
+        await asyncio.sleep(delay)
+
+
+async def _fetch_activities(access_token, start_unix, end_unix):
+    """
+    Request page 1, then further pages in windows of PAGE_WINDOW until a page
+    is not full. Incremental runs usually stop after the single first request.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+
+    def page_url(p):
+        return f"{BASE_URL}athlete/activities?before={end_unix}&after={start_unix}&page={p}&per_page={PER_PAGE}"
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        pages = [await _fetch_page(session, page_url(1))]
+        page = 1
+        activities = []
+        while True:
+            # Keep pages up to the first one that is not full
+            for page_respond in pages:
+                if page_respond:
+                    activities.extend(page_respond)
+                    logger.info(f"Found {page} pages of activities.")
+                if len(page_respond or []) < PER_PAGE:
+                    return activities
+                page += 1
+
+            pages = await asyncio.gather(
+                *[
+                    _fetch_page(session, page_url(p))
+                    for p in range(page, page + PAGE_WINDOW)
+                ]
+            )
+
+
 def get_activities(access_token, athlete, start_unix=None):
 
     end_unix = int(time.time())
 
-    activities = []
-    page = 1
-    while True:
-        url = f"{BASE_URL}athlete/activities?before={end_unix}&after={start_unix}&page={page}&per_page=30"
-        page_respond = make_request(url, access_token)
-        if not page_respond:
-            break
-
-        activities.extend(page_respond)
-        logger.info(f"Found {page} pages of activities.")
-        page += 1
+    activities = asyncio.run(_fetch_activities(access_token, start_unix, end_unix))
 
     if not activities:
         logger.info("No recent activities found. Database seems up to date!")
@@ -119,18 +201,18 @@ def get_activities(access_token, athlete, start_unix=None):
 
 
 def create_json(data, filepath):
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    with open(filepath, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     logger.info(f"{filepath} has been created or updated")
 
 
 def import_json(filepath):
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(filepath, "rb") as f:
+            data = orjson.loads(f.read())
         logger.info(f"Imported data from {filepath}")
         return data
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
         logger.error(f"Error reading {filepath}: {e}")
         return None
 
@@ -140,36 +222,49 @@ def make_request(url, access_token):
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
     }
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url, headers=headers, timeout=10)
     if response.status_code != 200:
         logger.error(f"HTTP error {response.status_code}: {response.reason}")
         return None
-    return response.json()
+    return orjson.loads(response.content)
 
 
 def convert_str_to_unix(date_str, assign_to_utc=True):
     if not date_str:
         logger.info("No time found")
-    if assign_to_utc:
-        naive_datetime = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
-        utc_datetime = pytz.utc.localize(naive_datetime)
 
-    unix_utc_timestamp = int(utc_datetime.timestamp())
+    # TIMESTAMPTZ values from postgres already arrive as datetime objects
+    if isinstance(date_str, datetime):
+        parsed_datetime = date_str
+    else:
+        parsed_datetime = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
+
+    if assign_to_utc and parsed_datetime.tzinfo is None:
+        parsed_datetime = parsed_datetime.replace(tzinfo=timezone.utc)
+
+    unix_utc_timestamp = int(parsed_datetime.timestamp())
 
     return unix_utc_timestamp
 
 
 # POSTGRES functions
 
+# Engine shared by all database calls (created on first use)
+_ENGINE = None
+
 
 def get_engine():
     """
     Create and return a SQLAlchemy engine for a PostgreSQL database.
     Loads credentials from a .env file and builds the connection string.
+    The engine is created once and reused on subsequent calls.
 
     Returns:
         Engine: SQLAlchemy engine connected to the specified database.
     """
+    global _ENGINE
+    if _ENGINE is not None:
+        return _ENGINE
 
     try:
 
@@ -180,10 +275,12 @@ def get_engine():
         DATABASE_NAME = os.environ["POSTGRES_DB"]
 
         # Create the engine using the credentials from the .env file
-        engine = create_engine(
-            f"postgresql+psycopg2://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+        _ENGINE = create_engine(
+            f"postgresql+psycopg2://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}",
+            pool_size=5,
+            pool_pre_ping=True,
         )
-        return engine
+        return _ENGINE
 
     except KeyError as e:
         logger.error(
@@ -216,29 +313,137 @@ def get_latest_datetime(datetime_col, table):
         return 1388530800  # timestamp refers to 2014
 
 
+def psql_copy(table, conn, keys, data_iter):
+    """
+    Insertion method for DataFrame.to_sql using PostgreSQL COPY FROM STDIN.
+
+    Streams rows as CSV through the raw psycopg2 cursor instead of issuing
+    one INSERT per row. Rows are copied in batches of INGEST_BATCH_SIZE so
+    only one batch is held as text at a time.
+    """
+    columns = ", ".join(f'"{k}"' for k in keys)
+    if table.schema:
+        table_name = f"{table.schema}.{table.name}"
+    else:
+        table_name = table.name
+
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        while batch := list(itertools.islice(data_iter, INGEST_BATCH_SIZE)):
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerows(batch)
+            buf.seek(0)
+
+            cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH CSV", buf)
+
+
+def to_arrow_type(sql_type):
+    """Map a SQLAlchemy column type onto the matching Arrow type."""
+    if isinstance(sql_type, BigInteger):
+        return pa.int64()
+    if isinstance(sql_type, Integer):
+        return pa.int32()
+    if isinstance(sql_type, Float):
+        return pa.float64()
+    if isinstance(sql_type, Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, DateTime):
+        return pa.timestamp("us", tz="UTC" if sql_type.timezone else None)
+    return pa.string()
+
+
+def cast_column(column, arrow_type):
+    """Cast an Arrow column, parsing ISO strings ("...Z") for timestamp targets."""
+    if pa.types.is_timestamp(arrow_type) and pa.types.is_string(column.type):
+        column = column.cast(pa.timestamp(arrow_type.unit, tz="UTC"))
+    return column.cast(arrow_type)
+
+
+def adbc_ingest(df, table, engine):
+    """
+    Append a DataFrame to an existing postgres table using ADBC bulk ingest.
+
+    The data is sent as a binary COPY straight from Arrow buffers. Binary COPY
+    does not coerce types server-side, so every column is cast to the Arrow
+    type matching the table schema first. Record batches of INGEST_BATCH_SIZE
+    rows are cast and streamed one at a time.
+    """
+    data = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    columns = {
+        col["name"]: to_arrow_type(col["type"])
+        for col in inspect(engine).get_columns(table)
+    }
+    schema = pa.schema([(name, columns[name]) for name in data.column_names])
+    batches = (
+        pa.RecordBatch.from_arrays(
+            [cast_column(batch[name], columns[name]) for name in schema.names],
+            schema=schema,
+        )
+        for batch in data.to_batches(max_chunksize=INGEST_BATCH_SIZE)
+    )
+    reader = pa.RecordBatchReader.from_batches(schema, batches)
+
+    uri = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    with pg_dbapi.connect(uri) as conn:
+        with conn.cursor() as cur:
+            cur.adbc_ingest(table, reader, mode="append")
+        conn.commit()
+
+
+def ingest_dataframe(df, table, engine):
+    """
+    Append a DataFrame to a postgres table using the fastest working path.
+
+    On postgres, tries ADBC binary COPY first, then CSV COPY via psql_copy.
+    Multi-row INSERTs in batches of 1000 rows are the last resort, e.g. for
+    backends without COPY support. Integrity and data errors (e.g. a duplicate
+    activity_id) are raised right away, as no other loader can fix the rows.
+    """
+    if engine.dialect.name == "postgresql":
+        try:
+            adbc_ingest(df, table, engine)
+            return
+        except (pg_dbapi.IntegrityError, pg_dbapi.DataError):
+            raise
+        except (pg_dbapi.Error, pa.ArrowException) as e:
+            logger.warning(f"Binary ingest failed ({e}). Falling back to CSV COPY ...")
+
+        try:
+            df.to_sql(
+                table, con=engine, if_exists="append", index=True, method=psql_copy
+            )
+            return
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            raise
+        except psycopg2.Error as e:
+            logger.warning(f"CSV COPY failed ({e}). Falling back to INSERT ...")
+
+    df.to_sql(
+        table,
+        con=engine,
+        if_exists="append",
+        index=True,
+        method="multi",
+        chunksize=1000,
+    )
+
+
 def create_table_with_schema(schema_file):
     """Load the SQL schema from a file and execute it."""
     try:
         with open(schema_file, "r") as file:
             schema_sql = file.read()
 
-        # Split commands by semicolon if multiple statements exist
-        commands = schema_sql.strip().split(";")
-
         engine = get_engine()
         if engine is None:
             logger.error("Engine could not be created. Aborting.")
             return
 
-        with engine.connect() as connection:
-            for command in commands:
-                command = command.strip()
-                if command:
-                    logger.info(f"Executing SQL command: {command[:50]}...")
-                    connection.execute(text(command))
-            connection.commit()  # ensure DDL statements are applied
-
-        engine.dispose()
+        # Run the whole file in one round trip; DDL commits atomically
+        with engine.begin() as connection:
+            logger.info(f"Executing SQL schema: {schema_file}")
+            connection.exec_driver_sql(schema_sql)
 
     except FileNotFoundError:
         logger.error(f"Schema file not found: {schema_file}")
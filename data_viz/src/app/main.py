@@ -3,18 +3,28 @@ import dash_bootstrap_components as dbc
 import plotly.io as pio
 import plotly.express as px
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import calendar
+import functools
 import logging
 from dash import dcc, html, dash_table
 from datetime import datetime
+from flask_caching import Cache
 from app.utils import (
     columns_shorter,
     col_rename_dict,
+    activities_query,
+    annual_cycling_query,
+    activities_fingerprint_query,
     activity_mapping,
+    sport_type_styles,
     get_engine,
     fetch_data,
     convert_units,
     generate_folium_map,
     get_metric_card,
+    get_signature,
     update_date_axis,
     get_speedometer,
 )
@@ -23,99 +33,140 @@ from app.utils import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Derived frames share memory until written to, no defensive copies needed
+pd.set_option("mode.copy_on_write", True)
 
-# Get current year and aimed distance goal
+# Initialize the Dash app
+app = dash.Dash(
+    __name__,
+    external_stylesheets=[dbc.themes.BOOTSTRAP],
+    suppress_callback_exceptions=True,
+)
+server = app.server  # Expose the Flask server instance for WSGI servers
+
+# Server-side cache, shared by all gunicorn workers
+cache = Cache(
+    server,
+    config={"CACHE_TYPE": "FileSystemCache", "CACHE_DIR": "/tmp/dashcache"},
+)
+
+
+def get_cached(key, signature, build):
+    """
+    Returns the value cached under a fixed key if it was built from data with
+    the same signature, otherwise builds it and replaces the cached entry.
+    One entry per key, so new data does not pile up entries in the cache dir.
+    """
+    cached = cache.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    value = build()
+    cache.set(key, (signature, value), timeout=0)
+    return value
+
+
+# Get current year
 now = datetime.now()
 timestamp = now.strftime("%Y-%m-%d %H:%M")
 current_year = now.year
 start_date = pd.to_datetime(f"{current_year}-01-01")
 end_date = pd.to_datetime(f"{current_year}-12-31")
-days_in_year = (end_date - start_date).days + 1
-
-# Define annual distance goal
-# total_goal_distance = 8000  # NOTE Hardcoded
-# daily_distance_goal = total_goal_distance / days_in_year  # km/day
-# goal_dates = pd.date_range(start_date, end_date, freq="D")
-# goal_distances = daily_distance_goal * (goal_dates - start_date).days
 
 
-# activities = pd.read_csv("data_fetch/src/app/activities.csv", index_col="activity_id")
+# activities = pd.read_csv(
+#     "data_fetch/src/app/activities.csv",
+#     index_col="activity_id",
+#     engine="pyarrow",
+#     dtype_backend="pyarrow",
+# )
 
 # Connect and fetch data from psql
 engine = get_engine()
-athlete = fetch_data(
-    engine,
-    "SELECT * FROM athlete",
-    index_col="athlete_id",
-)
 
+# Cheap fingerprint of the activities table; cached results are keyed on it,
+# so they are rebuilt only after data_fetch has added new activities
+fingerprint = fetch_data(engine, activities_fingerprint_query)
+fingerprint = "|".join(fingerprint.iloc[0].astype(str))
+
+
+@cache.memoize(timeout=3600)
+def cached_fetch(query, index_col, fingerprint):
+    return fetch_data(engine, query, index_col)
+
+
+athlete = cached_fetch("SELECT * FROM athlete", "athlete_id", fingerprint)
+
+# Own directory, cachelib would prune or clear foreign files in /tmp/dashcache
 activities = fetch_data(
     engine,
-    "SELECT * FROM activities",
+    activities_query,
     "activity_id",
+    cache_path="/tmp/dashdata/activities.parquet",
+    cache_key=fingerprint,
 )
 
-activities = activities.drop_duplicates()
-activities["start_date"] = pd.to_datetime(activities["start_date"])
+activities = activities[~activities.index.duplicated(keep="first")]
+# Few distinct sport types, so filters and lookups work on category codes
+activities["sport_type"] = activities["sport_type"].astype("category")
 activities = activities.sort_values("start_date", ascending=False)
 
 # Tidy up activities dataframe
 activities_ready = convert_units(activities, rounding_digits=1)
-activities_ready["name"] = activities_ready["name"].apply(
-    lambda x: x[:40]
-)  # Shorten names for display
+# Shorten names for display (sliced on the Arrow string buffer)
+activities_ready["name"] = (
+    activities_ready["name"].astype("string[pyarrow]").str.slice(0, 40)
+)
 
 
-# Get cumulative distance for each year
-activities_ready = activities_ready.reset_index()
+# Get cumulative distance for each year (assigned back by activity_id). The
+# frame is already sorted newest first, so reversing it gives date order
 activities_ready["start_year"] = activities_ready["start_date"].dt.year
 activities_ready["annual_cumulative_distance"] = (
-    activities_ready.sort_values("start_date")
-    .groupby("start_year")["distance"]
-    .cumsum()
-)
-activities_ready = activities_ready.set_index("activity_id")
-activities_ready = activities_ready.copy()
-activities_ready["start_date_current_year"] = activities_ready["start_date"].apply(
-    lambda x: x.replace(year=current_year)
+    activities_ready.iloc[::-1].groupby("start_year", sort=False)["distance"].cumsum()
 )
 
-activities_ready["CURRENT_YEAR"] = current_year
-
+# Move all dates into the current year (Feb 29 falls back to Feb 28 unless
+# the current year is a leap year itself)
+start_dates = activities_ready["start_date"]
+leap_day = (start_dates.dt.month == 2) & (start_dates.dt.day == 29)
+leap_day &= not calendar.isleap(current_year)
+start_dates = start_dates.where(~leap_day, start_dates - pd.Timedelta(days=1))
+activities_ready["start_date_current_year"] = pd.to_datetime(
+    pd.DataFrame(
+        {
+            "year": current_year,
+            "month": start_dates.dt.month,
+            "day": start_dates.dt.day,
+        }
+    )
+).dt.tz_localize(start_dates.dt.tz) + (start_dates - start_dates.dt.normalize())
 
-# Creating df of annual summaries
-annual_cycling = activities[
-    activities["sport_type"].isin(["Ride", "MountainBikeRide", "VirtualRide"])
-]
-annual_cycling = annual_cycling.groupby(
-    activities["start_date"].dt.tz_convert(None).dt.to_period("Y")
-).agg(
-    n_activities=("resource_state", "size"),
-    total_distance=("distance", "sum"),
-    total_moving_time=("moving_time", "sum"),
-    total_elevation_gain=("total_elevation_gain", "sum"),
-    max_speed=("max_speed", "max"),
-    average_speed=("average_speed", "mean"),
-)
+activities_ready["CURRENT_YEAR"] = current_year
 
-annual_cycling["average_speed_weighted"] = activities.groupby(
-    activities["start_date"].dt.tz_convert(None).dt.to_period("Y")
-).apply(lambda x: (x["average_speed"] * x["distance"]).sum() / x["distance"].sum())
 
-annual_cycling = convert_units(
-    annual_cycling,
-    rounding_digits=1,
-).reset_index(drop=False)
-annual_cycling["start_date"] = annual_cycling["start_date"].astype(str).astype(int)
-annual_cycling = annual_cycling.sort_values("start_date", ascending=False)
+# Creating df of annual summaries (aggregated in postgres)
+annual_cycling = cached_fetch(annual_cycling_query, None, fingerprint)
+annual_cycling = convert_units(annual_cycling, rounding_digits=1)
 annual_cycling_viz = annual_cycling.rename(columns=col_rename_dict)
 
-# Final cleaning of table column (needs to be after generating cumulative distance)
-activities_viz = activities_ready.copy()
-activities_viz["start_date"] = activities_viz["start_date"].dt.strftime("%B %d, %Y")
-activities_viz["sport_type"] = activities_viz["sport_type"].replace(activity_mapping)
-activities_viz = activities_viz.rename(columns=col_rename_dict)
-activities_viz["start_date_local"] = pd.to_datetime(activities_viz["start_date_local"])
+# Final cleaning of table column (needs to be after generating cumulative distance).
+# Built as one Arrow table, so the formatting steps don't each copy the frame.
+# The pandas metadata is dropped as it would restore the old start_date dtype
+activities_table = pa.Table.from_pandas(activities_ready).replace_schema_metadata()
+sport_types = activities_table["sport_type"].combine_chunks().dictionary_encode()
+sport_labels = [activity_mapping.get(s, s) for s in sport_types.dictionary.to_pylist()]
+activities_table = activities_table.set_column(
+    activities_table.schema.get_field_index("start_date"),
+    "start_date",
+    pc.strftime(activities_table["start_date"], "%B %d, %Y"),
+).set_column(
+    activities_table.schema.get_field_index("sport_type"),
+    "sport_type",
+    pa.DictionaryArray.from_arrays(sport_types.indices, sport_labels).cast(pa.string()),
+)
+activities_viz = activities_table.to_pandas(split_blocks=True, self_destruct=True)
+activities_viz = activities_viz.set_index("activity_id").rename(columns=col_rename_dict)
+del activities_table
 
 # Set templates
 pio.templates.default = "simple_white"
@@ -151,73 +202,101 @@ cards = [
     for metric in metrics
 ]
 
-# Line graph of cumulative distance (current year)
-fig_annual_cumsum = px.line(
-    activities_ready.query("sport_type in ['Ride', 'MountainBikeRide', 'VirtualRide']"),
-    x="start_date_current_year",
-    y="annual_cumulative_distance",
-    color="start_year",
-    color_discrete_sequence=px.colors.qualitative.G10,
-    hover_data=["start_year", "annual_cumulative_distance"],
-)
 
-# Adding line graph of cumulative distance (all previous years)
+# Line graph of cumulative distance (current year). Built on first use and
+# cached as JSON while the plotted columns (which also encode the year) match
+def build_fig_annual_cumsum_json():
+    fig_annual_cumsum = px.line(
+        activities_ready.query(
+            "sport_type in ['Ride', 'MountainBikeRide', 'VirtualRide']"
+        ),
+        x="start_date_current_year",
+        y="annual_cumulative_distance",
+        color="start_year",
+        color_discrete_sequence=px.colors.qualitative.G10,
+        hover_data=["start_year", "annual_cumulative_distance"],
+    )
 
-# fig_annual_cumsum.add_scatter(
-#     x=activities_ready.query("start_year == @current_year")["start_date_current_year"],
-#     y=activities_ready.query("start_year == @current_year")[
-#         "annual_cumulative_distance"
-#     ],
-#     mode="lines",
-#     line=dict(color=px.colors.sequential.Blues[-1]),
-# )
-fig_annual_cumsum.update_layout(
-    yaxis=dict(title=f"Annual cumulative Distance (km)"),
-    legend=dict(
-        x=0.03,  # Place at the right side of the plot area
-        y=0.95,  # Place at the bottom side of the plot area
-        xanchor="left",  # Anchor the legend to the right
-        yanchor="top",  # Anchor the legend to the bottom
-    ),
-)
-update_date_axis(fig_annual_cumsum, start_date, end_date, freq="MS")
+    # Adding line graph of cumulative distance (all previous years)
+
+    # fig_annual_cumsum.add_scatter(
+    #     x=activities_ready.query("start_year == @current_year")["start_date_current_year"],
+    #     y=activities_ready.query("start_year == @current_year")[
+    #         "annual_cumulative_distance"
+    #     ],
+    #     mode="lines",
+    #     line=dict(color=px.colors.sequential.Blues[-1]),
+    # )
+    fig_annual_cumsum.update_layout(
+        yaxis=dict(title=f"Annual cumulative Distance (km)"),
+        legend=dict(
+            x=0.03,  # Place at the right side of the plot area
+            y=0.95,  # Place at the bottom side of the plot area
+            xanchor="left",  # Anchor the legend to the right
+            yanchor="top",  # Anchor the legend to the bottom
+        ),
+    )
+    update_date_axis(fig_annual_cumsum, start_date, end_date, freq="MS")
+    return fig_annual_cumsum.to_json()
 
 
-# NOTE DEPRECATED
-# fig_annual_cumsum.add_scatter(
-#     x=goal_dates,  # The date range for the goal
-#     y=goal_distances,  # The cumulative goal distance
-#     mode="lines",
-#     name=f"Reference line for annual aim ({total_goal_distance} km)",  # Label for the goal line
-#     line=dict(color="grey", dash="dash"),  # Customize the line style (red, dashed)
-# )
+# Bump when changing the figure layout, so the cached figure is rebuilt
+FIG_CACHE_VERSION = 1
 
-# Creating heatmap
-generate_folium_map(
-    activities,
-    "heatmap_all_activities.html",
-    "Sport type",
-    5,
-    "median",
-    # (49.37, 8.78),  # Heidelberg
-)
 
-generate_folium_map(
-    activities.head(1),
-    "last_activity.html",
-    "Last activity",
-    11,
-    "last",
-)
+@functools.lru_cache(maxsize=1)
+def get_fig_annual_cumsum():
+    fig_columns = [
+        "sport_type",
+        "start_date_current_year",
+        "annual_cumulative_distance",
+        "start_year",
+    ]
+    fig_signature = (
+        FIG_CACHE_VERSION,
+        get_signature(activities_ready, fig_columns),
+    )
+    return pio.from_json(
+        get_cached("fig_annual_cumsum", fig_signature, build_fig_annual_cumsum_json)
+    )
 
 
-# Initialize the Dash app
-app = dash.Dash(
-    __name__,
-    external_stylesheets=[dbc.themes.BOOTSTRAP],
-    suppress_callback_exceptions=True,
+# Creating heatmap (slowest step, so the rendered HTML is cached as well).
+# The cached maps are reused while the columns they are drawn from are unchanged;
+# bump MAP_CACHE_VERSION when changing how the maps are drawn
+MAP_CACHE_VERSION = 1
+map_columns = ["summary_polyline", "sport_type", "start_date", "name", "start_latlng"]
+map_signature = (
+    MAP_CACHE_VERSION,
+    repr(sport_type_styles),
+    get_signature(activities, map_columns),
 )
-server = app.server  # Expose the Flask server instance for WSGI servers
+
+
+def build_maps():
+    heatmap_html = generate_folium_map(
+        activities,
+        "heatmap_all_activities.html",
+        "Sport type",
+        5,
+        "median",
+        # (49.37, 8.78),  # Heidelberg
+    )
+
+    last_activity_html = generate_folium_map(
+        activities.head(1),
+        "last_activity.html",
+        "Last activity",
+        11,
+        "last",
+    )
+    return heatmap_html, last_activity_html
+
+
+heatmap_html, last_activity_html = get_cached("maps", map_signature, build_maps)
+
+cards_row = dbc.Row([dbc.Col(card, width="auto") for card in cards], justify="around")
+
 app.layout = html.Div(
     [
         # Top container fills the viewport minus the bottom fixed container.
@@ -327,140 +406,141 @@ app.layout = html.Div(
 )
 
 
+# Tab layouts are static, so build them (and their table records) only once
+lifetime_records = activities_viz[columns_shorter].to_dict("records")
+annual_records = annual_cycling_viz.to_dict("records")
+
+tab_layouts = {
+    "last": html.Div(
+        [
+            html.Iframe(
+                srcDoc=last_activity_html,  # Saved HTML file
+                width="100%",  # Width of the map
+                height="600",  # Height of the map
+            ),
+            cards_row,
+            # NOTE DEPRECATED TABLE
+            # dash_table.DataTable(
+            #     id="table_activities",
+            #     columns=[{"name": i, "id": i} for i in activities_viz.columns],
+            #     data=activities_viz.head(1).to_dict("records"),
+            #     style_table={"width": "100%", "margin": "auto"},
+            #     style_cell={"textAlign": "right"},
+            #     style_header={"fontWeight": "bold"},
+            #     # Enable sorting, filtering, and pagination
+            #     sort_action="native",
+            #     # filter_action="native",
+            #     page_action="native",
+            #     page_size=100,  # Show 5 row sper page
+            # ),
+        ]
+    ),
+    "lifetime": html.Div(
+        [
+            html.Iframe(
+                srcDoc=heatmap_html,  # Saved HTML file
+                width="100%",  # Width of the map
+                height="600",  # Height of the map
+            ),
+            dash_table.DataTable(
+                id="table_activities",
+                columns=[
+                    {"name": i, "id": i}
+                    for i in activities_viz[columns_shorter].columns
+                ],
+                data=lifetime_records,
+                style_table={"width": "100%", "margin": "auto"},
+                style_cell={"textAlign": "right"},
+                style_header={"fontWeight": "bold"},
+                # Enable sorting, filtering, and pagination
+                sort_action="native",
+                # filter_action="native",
+                page_action="native",
+                page_size=5,  # Show 5 row sper page
+            ),
+        ]
+    ),
+    "metrics_comparison": html.Div(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Label("Select Y-value", style={"fontWeight": "bold"}),
+                            dcc.Dropdown(
+                                id="metrics_y_dropdown",
+                                options=[{"label": m, "value": m} for m in metrics],
+                                value="Elevation [m]",
+                                clearable=False,
+                            ),
+                        ],
+                        width=6,  # takes half the row on medium+ screens, full width on small
+                    ),
+                    dbc.Col(
+                        [
+                            html.Label("Select X-value", style={"fontWeight": "bold"}),
+                            dcc.Dropdown(
+                                id="metrics_x_dropdown",
+                                options=[{"label": m, "value": m} for m in metrics],
+                                value="Distance [km]",
+                                clearable=False,
+                            ),
+                        ],
+                        width=6,
+                    ),
+                ],
+                justify="center",  # horizontally center the row
+                className="mb-3",  # margin below
+            ),
+            html.Div(
+                dcc.Graph(id="fig_metrics_comparison"),
+                style={
+                    "width": "100%",  # responsive width
+                    "maxWidth": "900px",  # maximum width
+                    "margin": "0 auto",  # center horizontally
+                },
+            ),
+        ]
+    ),
+}
+
+
+# The annual overview holds the plotly figure, so it is built on first visit
+@functools.lru_cache(maxsize=1)
+def get_annual_overview_layout():
+    return html.Div(
+        [
+            dcc.Graph(
+                id="annual_summary_graph",
+                figure=get_fig_annual_cumsum(),
+                style={"width": "100%", "height": "600px"},
+            ),
+            dash_table.DataTable(
+                id="table_annual_summaries",
+                columns=[{"name": i, "id": i} for i in annual_cycling_viz.columns],
+                data=annual_records,
+                style_table={"width": "100%", "margin": "auto"},
+                style_cell={"textAlign": "right"},
+                style_header={"fontWeight": "bold"},
+                # Enable sorting, filtering, and pagination
+                # sort_action="native",
+                # filter_action="native",
+                page_action="native",
+                page_size=5,
+            ),
+        ]
+    )
+
+
 # Callback to update content based on selected tab
 @app.callback(
     dash.dependencies.Output("tabs-content", "children"),
     [dash.dependencies.Input("tabs", "value")],
 )
 def render_content(tab):
-    if tab == "last":
-
-        return html.Div(
-            [
-                html.Iframe(
-                    srcDoc=open(
-                        "last_activity.html", "r"
-                    ).read(),  # Load the saved HTML file
-                    width="100%",  # Width of the map
-                    height="600",  # Height of the map
-                ),
-                dbc.Row(
-                    [dbc.Col(card, width="auto") for card in cards], justify="around"
-                ),
-                # NOTE DEPRECATED TABLE
-                # dash_table.DataTable(
-                #     id="table_activities",
-                #     columns=[{"name": i, "id": i} for i in activities_viz.columns],
-                #     data=activities_viz.head(1).to_dict("records"),
-                #     style_table={"width": "100%", "margin": "auto"},
-                #     style_cell={"textAlign": "right"},
-                #     style_header={"fontWeight": "bold"},
-                #     # Enable sorting, filtering, and pagination
-                #     sort_action="native",
-                #     # filter_action="native",
-                #     page_action="native",
-                #     page_size=100,  # Show 5 row sper page
-                # ),
-            ]
-        )
-    elif tab == "lifetime":
-        return html.Div(
-            [
-                html.Iframe(
-                    srcDoc=open(
-                        "heatmap_all_activities.html", "r"
-                    ).read(),  # Load the saved HTML file
-                    width="100%",  # Width of the map
-                    height="600",  # Height of the map
-                ),
-                dash_table.DataTable(
-                    id="table_activities",
-                    columns=[
-                        {"name": i, "id": i}
-                        for i in activities_viz[columns_shorter].columns
-                    ],
-                    data=activities_viz[columns_shorter].to_dict("records"),
-                    style_table={"width": "100%", "margin": "auto"},
-                    style_cell={"textAlign": "right"},
-                    style_header={"fontWeight": "bold"},
-                    # Enable sorting, filtering, and pagination
-                    sort_action="native",
-                    # filter_action="native",
-                    page_action="native",
-                    page_size=5,  # Show 5 row sper page
-                ),
-            ]
-        )
-    elif tab == "annual_overview":
-        return html.Div(
-            [
-                dcc.Graph(
-                    id="annual_summary_graph",
-                    figure=fig_annual_cumsum,
-                    style={"width": "100%", "height": "600px"},
-                ),
-                dash_table.DataTable(
-                    id="table_annual_summaries",
-                    columns=[{"name": i, "id": i} for i in annual_cycling_viz.columns],
-                    data=annual_cycling_viz.to_dict("records"),
-                    style_table={"width": "100%", "margin": "auto"},
-                    style_cell={"textAlign": "right"},
-                    style_header={"fontWeight": "bold"},
-                    # Enable sorting, filtering, and pagination
-                    # sort_action="native",
-                    # filter_action="native",
-                    page_action="native",
-                    page_size=5,
-                ),
-            ]
-        )
-    elif tab == "metrics_comparison":
-        return html.Div(
-            [
-                dbc.Row(
-                    [
-                        dbc.Col(
-                            [
-                                html.Label(
-                                    "Select Y-value", style={"fontWeight": "bold"}
-                                ),
-                                dcc.Dropdown(
-                                    id="metrics_y_dropdown",
-                                    options=[{"label": m, "value": m} for m in metrics],
-                                    value="Elevation [m]",
-                                    clearable=False,
-                                ),
-                            ],
-                            width=6,  # takes half the row on medium+ screens, full width on small
-                        ),
-                        dbc.Col(
-                            [
-                                html.Label(
-                                    "Select X-value", style={"fontWeight": "bold"}
-                                ),
-                                dcc.Dropdown(
-                                    id="metrics_x_dropdown",
-                                    options=[{"label": m, "value": m} for m in metrics],
-                                    value="Distance [km]",
-                                    clearable=False,
-                                ),
-                            ],
-                            width=6,
-                        ),
-                    ],
-                    justify="center",  # horizontally center the row
-                    className="mb-3",  # margin below
-                ),
-                html.Div(
-                    dcc.Graph(id="fig_metrics_comparison"),
-                    style={
-                        "width": "100%",  # responsive width
-                        "maxWidth": "900px",  # maximum width
-                        "margin": "0 auto",  # center horizontally
-                    },
-                ),
-            ]
-        )
+    if tab == "annual_overview":
+        return get_annual_overview_layout()
+    return tab_layouts.get(tab)
 
 
 @app.callback(
@@ -4,7 +4,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
 import numpy as np
 import pandas as pd
-import ast
+import adbc_driver_postgresql.dbapi as pg_dbapi
+import hashlib
 import logging
 import polyline
 import dash_bootstrap_components as dbc
@@ -85,37 +86,91 @@ col_rename_dict = {
     "average_temp": "Temperatur °C",
 }
 
-# TODO sport_type is mapped two times (see also legend below)
+# Only the activity columns used by the dashboard (tables, cards and maps)
+activities_query = """
+SELECT
+    activity_id,
+    name,
+    sport_type,
+    start_date,
+    start_date_local,
+    distance,
+    moving_time,
+    total_elevation_gain,
+    average_speed,
+    max_speed,
+    average_cadence,
+    average_temp,
+    weighted_average_watts,
+    max_watts,
+    start_latlng,
+    summary_polyline
+FROM activities
+"""
+
+# Annual cycling summaries, aggregated on the database server
+annual_cycling_query = """
+SELECT
+    EXTRACT(YEAR FROM start_date AT TIME ZONE 'UTC')::int AS start_date,
+    COUNT(*) AS n_activities,
+    SUM(distance) AS total_distance,
+    SUM(moving_time) AS total_moving_time,
+    SUM(total_elevation_gain) AS total_elevation_gain,
+    MAX(max_speed) AS max_speed,
+    AVG(average_speed) AS average_speed,
+    SUM(average_speed * distance) / NULLIF(SUM(distance), 0) AS average_speed_weighted
+FROM activities
+WHERE sport_type IN ('Ride', 'MountainBikeRide', 'VirtualRide')
+GROUP BY 1
+ORDER BY 1 DESC
+"""
+
+# Changes whenever new activities are ingested
+activities_fingerprint_query = "SELECT max(start_date), count(*) FROM activities"
+
+# Color and display label per sport type (maps, legend, cards and tables)
+sport_type_styles = {
+    "Ride": ("#1f78b4", "Road bike"),
+    "MountainBikeRide": ("#ff7f00", "MTB"),
+    "Hike": ("#33a02c", "Hike"),
+    "VirtualRide": ("#6a3d9a", "VirtualRide"),
+}
+other_sport_type_style = ("#e31a1c", "Other")
+
+# Sport types shown under a different name in the tables
 activity_mapping = {
-    "Ride": "Road bike",
-    "MountainBikeRide": "MTB",
+    sport_type: label
+    for sport_type, (_, label) in sport_type_styles.items()
+    if label != sport_type
 }
 
 
 def get_sport_type_color(sport_type):
     """
-    Returns a hex color string for the given sport_type.
+    Returns a hex color string for the given sport_type or its display label.
     """
-    if sport_type == "Ride" or sport_type == "Road bike":
-        return "#1f78b4"
-    elif sport_type == "MountainBikeRide" or sport_type == "MTB":
-        return "#ff7f00"
-    elif sport_type == "Hike":
-        return "#33a02c"
-    elif sport_type == "VirtualRide":
-        return "#6a3d9a"
-    else:
-        return "#e31a1c"
+    for name, (color, label) in sport_type_styles.items():
+        if sport_type in (name, label):
+            return color
+    return other_sport_type_style[0]
+
+
+# Engine shared by all database calls (created on first use)
+_ENGINE = None
 
 
 def get_engine():
     """
     Create and return a SQLAlchemy engine for a PostgreSQL database.
     Loads credentials from a .env file and builds the connection string.
+    The engine is created once and reused on subsequent calls.
 
     Returns:
         Engine: SQLAlchemy engine connected to the specified database.
     """
+    global _ENGINE
+    if _ENGINE is not None:
+        return _ENGINE
 
     try:
 
@@ -126,10 +181,12 @@ def get_engine():
         DATABASE_NAME = os.environ["POSTGRES_DB"]
 
         # Create the engine using the credentials from the .env file
-        engine = create_engine(
-            f"postgresql+psycopg2://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+        _ENGINE = create_engine(
+            f"postgresql+psycopg2://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}",
+            pool_size=5,
+            pool_pre_ping=True,
         )
-        return engine
+        return _ENGINE
 
     except KeyError as e:
         logger.error(
@@ -141,7 +198,26 @@ def get_engine():
         return None
 
 
-def fetch_data(engine, query, index_col=None):
+def read_sql_arrow(engine, query, index_col=None):
+    """
+    Run a query over ADBC and return the result as ArrowDtype-backed DataFrame.
+
+    Rows arrive from postgres as Arrow record batches, so no cell is converted
+    through a Python object on the way into pandas.
+    """
+    uri = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    with pg_dbapi.connect(uri) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            table = cur.fetch_arrow_table()
+
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    if index_col is not None:
+        df = df.set_index(index_col)
+    return df
+
+
+def fetch_data(engine, query, index_col=None, cache_path=None, cache_key=None):
     """
     Fetches data from a PostgreSQL database using a SQLAlchemy engine.
 
@@ -153,6 +229,11 @@ def fetch_data(engine, query, index_col=None):
         query (str): The SQL query string to be executed.
         index_col (str, optional): Column to set as the index of the DataFrame.
                                    Defaults to None.
+        cache_path (str, optional): Parquet file caching the query result.
+                                    Only used together with cache_key.
+        cache_key (str, optional): Value that changes with the data, e.g. a
+                                   table fingerprint; the cache is reused
+                                   while it and the query match.
 
     Returns:
         pd.DataFrame | None: A pandas DataFrame containing the query results,
@@ -162,17 +243,48 @@ def fetch_data(engine, query, index_col=None):
         logger.error("Invalid query provided. Query must be a non-empty string.")
         return None
 
+    use_cache = cache_path is not None and cache_key is not None
+    meta_path = f"{cache_path}.meta"
+    if use_cache:
+        # A changed query or index must not be served the old column set
+        query_digest = hashlib.sha256(f"{query}|{index_col}".encode()).hexdigest()
+        cache_key = f"{cache_key}|{query_digest}"
+    if use_cache and os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if f.read() == cache_key:
+                logger.info(f"Loading cached result from {cache_path}")
+                return pd.read_parquet(cache_path, dtype_backend="pyarrow")
+
     try:
-        logger.info("Attempting to connect to the database...")
-        with engine.connect() as connection:
-            logger.info(f"Executing query: {query[:50]}...")
-            df = pd.read_sql(query, connection, index_col=index_col)
-            logger.info("Query executed successfully.")
-            if not df.empty:
-                return df
-            else:
-                logger.info("DataFrame empty.")
-                return None
+        logger.info(f"Executing query: {query[:50]}...")
+        df = None
+        if engine.dialect.name == "postgresql":
+            try:
+                df = read_sql_arrow(engine, query, index_col)
+            except pg_dbapi.Error as e:
+                logger.warning(f"ADBC read failed ({e}). Falling back to read_sql")
+        if df is None:
+            # Pooled SQLAlchemy connection, only checked out when actually used
+            logger.info("Attempting to connect to the database...")
+            with engine.connect() as connection:
+                df = pd.read_sql(
+                    query, connection, index_col=index_col, dtype_backend="pyarrow"
+                )
+        logger.info("Query executed successfully.")
+        if not df.empty:
+            if use_cache:
+                # Write to temp files first, other workers may read meanwhile
+                os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+                tmp_suffix = f".{os.getpid()}.tmp"
+                df.to_parquet(cache_path + tmp_suffix, compression="zstd")
+                os.replace(cache_path + tmp_suffix, cache_path)
+                with open(meta_path + tmp_suffix, "w") as f:
+                    f.write(cache_key)
+                os.replace(meta_path + tmp_suffix, meta_path)
+            return df
+        else:
+            logger.info("DataFrame empty.")
+            return None
 
     except SQLAlchemyError as e:
         logger.error(f"Database error during query execution: {e}")
@@ -193,6 +305,18 @@ def fetch_data(engine, query, index_col=None):
         return None
 
 
+def decode_polyline(encoded_polyline):
+    """
+    Decode a polyline into GeoJSON ordered (lon, lat) coordinates.
+    Errors are returned rather than raised, so one bad route does not abort the
+    whole map.
+    """
+    try:
+        return polyline.decode(encoded_polyline, geojson=True)
+    except Exception as e:
+        return e
+
+
 def generate_folium_map(
     activities,
     file_name,
@@ -202,7 +326,8 @@ def generate_folium_map(
     marker_opacity=0.5,
 ):
     """
-    Generate an interactive Folium map of activities. Saves it as .html file in root repo.
+    Generate an interactive Folium map of activities. Saves it as .html file in root repo
+    and returns the rendered HTML.
 
     Plots activity routes from encoded polylines with sport-specific colors
     and adds a legend based on sport type.
@@ -221,22 +346,16 @@ def generate_folium_map(
             Defaults to 0.5.
     """
 
-    activities = activities.copy()
-
     # Check coordinates
     if lat_lon == "median":
-        activities["start_latlng"] = activities["start_latlng"].apply(ast.literal_eval)
-        lats = (
-            activities["start_latlng"]
-            .apply(lambda x: x[0] if isinstance(x, list) and len(x) == 2 else None)
-            .to_list()
-        )
-        lons = (
+        # "[lat, lon]" strings; empty "[]" (manual activities) become NaN
+        coordinates = (
             activities["start_latlng"]
-            .apply(lambda x: x[1] if isinstance(x, list) and len(x) == 2 else None)
-            .to_list()
+            .str.extract(r"\[(?P<lat>[-\d.eE]+),\s*(?P<lon>[-\d.eE]+)\]")
+            .astype("float64")
+            .to_numpy()
         )
-        lat_lon = (np.nanmedian(lats), np.nanmedian(lons))
+        lat_lon = (np.nanmedian(coordinates[:, 0]), np.nanmedian(coordinates[:, 1]))
 
     elif lat_lon == "last":
         coordinates = polyline.decode(activities["summary_polyline"].iloc[0])
@@ -265,51 +384,54 @@ def generate_folium_map(
     # Dictionary to hold the colors and labels for the legend
     legend_items = {}
 
-    for activity in activities.index:
-        activity_data = activities.loc[activity]
-        activity_polyline = activity_data["summary_polyline"]
+    decoded = [decode_polyline(p) for p in activities["summary_polyline"]]
 
-        try:
-            coordinates = polyline.decode(activity_polyline)
-        except Exception as e:
+    # Collect all routes into one GeoJSON layer instead of one PolyLine each
+    features = []
+    for activity, coordinates, sport_type, start_date, name in zip(
+        activities.index,
+        decoded,
+        activities["sport_type"],
+        activities["start_date"],
+        activities["name"],
+    ):
+        if isinstance(coordinates, Exception):
             print(f"Error decoding polyline")
-            print(f"Error details: {e}")
+            print(f"Error details: {coordinates}")
             print()
             print(activity)
             print()
             continue
 
-        sport_type = activity_data["sport_type"]
-
-        # Determine the color based on sport type
-        color = get_sport_type_color(sport_type)
-
-        # TODO wrap lines below in own function
-        if sport_type == "Ride":
-            label = "Road bike"
-        elif sport_type == "MountainBikeRide":
-            label = "MTB"
-        elif sport_type == "Hike":
-            label = sport_type
-        elif sport_type == "VirtualRide":
-            label = sport_type
-        else:
-            label = "Other"
+        # Determine the color and legend label based on sport type
+        color, label = sport_type_styles.get(sport_type, other_sport_type_style)
 
         # Add the color and label to our legend dictionary if it's not already there
         legend_items[label] = color
 
         # Popup/tooltip
-        date_str = str(activity_data["start_date"])[:10]
-        popup_tooltip = f"{date_str} | {activity_data['name']}"
-        # Add a PolyLine to connect the coordinates
-        folium.PolyLine(
-            coordinates,
-            popup=popup_tooltip,
-            tooltip=popup_tooltip,
-            color=color,
-            weight=2.5,
-            opacity=marker_opacity,
+        date_str = str(start_date)[:10]
+        popup_tooltip = f"{date_str} | {name}"
+        features.append(
+            {
+                "type": "Feature",
+                "id": str(activity),
+                "geometry": {"type": "LineString", "coordinates": coordinates},
+                "properties": {"color": color, "tooltip": popup_tooltip},
+            }
+        )
+
+    # The popup/tooltip fields can't be validated without any features
+    if features:
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            style_function=lambda feature: {
+                "color": feature["properties"]["color"],
+                "weight": 2.5,
+                "opacity": marker_opacity,
+            },
+            popup=folium.GeoJsonPopup(fields=["tooltip"], labels=False),
+            tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False),
         ).add_to(mymap)
 
     # --- Create the custom legend HTML ---
@@ -345,39 +467,56 @@ def generate_folium_map(
     # Add the HTML legend to the map
     mymap.get_root().html.add_child(folium.Element(legend_html))
 
-    # Save the map to an HTML file
-    mymap.save(file_name)
+    # Save the map to an HTML file. Written to a temp file first, as several
+    # workers may render the same map at once
+    map_html = mymap.get_root().render()
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_file_name, "w") as f:
+        f.write(map_html)
+    os.replace(tmp_file_name, file_name)
+
+    return map_html
 
 
 def findColumns(df, search_term):
-    found_columns = [col for col in df.columns if search_term in col]
+    found_columns = df.columns[df.columns.str.contains(search_term, regex=False)]
     # print(f"Found {len(found_columns)} columns having {search_term} in name")
     return found_columns
 
 
-def convert_units(df, rounding_digits=0):
-    df = df.copy()
+def get_signature(df, columns):
+    """
+    Returns a hex digest of the values in the given columns, e.g. to key
+    cached artefacts that are built from them.
+    """
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    return hashlib.blake2b(hashes.to_numpy().tobytes()).hexdigest()
 
-    # Convert distance from meters to kilometers and overwrite column
-    distance_cols = findColumns(df, "distance")
-    for distance_col in distance_cols:
-        df[distance_col] = round(df[distance_col] / 1000, rounding_digits)
 
-    # Convert moving_time (seconds) to timedelta and then to minutes, overwrite the column
+def convert_units(df, rounding_digits=0):
+    distance_cols = findColumns(df, "distance")
     time_cols = findColumns(df, "_time")
+    speed_cols = findColumns(df, "_speed")
+
+    # Shallow copy; with copy-on-write only the overwritten columns are new
+    df = df.copy(deep=False)
+
+    # Convert distance from meters to kilometers and overwrite columns
+    df[distance_cols] = df[distance_cols].div(1000).round(rounding_digits)
+
+    # Format durations (seconds) as "<days> days HH:MM"
     for time_col in time_cols:
-        df[time_col] = pd.to_timedelta(df[time_col], unit="s")
-        df[time_col] = df[time_col].apply(
-            lambda x: f"{x.components.days} days {x.components.hours:02}:{x.components.minutes:02}"
-        )
+        seconds = df[time_col].astype("int64")
+        days = (seconds // 86400).astype(str)
+        hours = (seconds % 86400 // 3600).astype(str).str.zfill(2)
+        minutes = (seconds % 3600 // 60).astype(str).str.zfill(2)
+        df[time_col] = days + " days " + hours + ":" + minutes
 
     # Convert speed from m/s to km/h and overwrite the columns
-    speed_cols = findColumns(df, "_speed")
-    for speed_col in speed_cols:
-        df[speed_col] = round(df[speed_col] * 3.6, rounding_digits)
+    df[speed_cols] = df[speed_cols].mul(3.6).round(rounding_digits)
 
     # Rounding elevation gain
-    df["total_elevation_gain"] = round(df["total_elevation_gain"], rounding_digits)
+    df["total_elevation_gain"] = df["total_elevation_gain"].round(rounding_digits)
 
     return df
 